@@ -0,0 +1,49 @@
+import argparse
+import datetime
+import json
+import subprocess
+from loadtest import find_web_urls, run_load_test
+from util import print_response
+
+# チューニング前(httpd24のデフォルト設定)と後で、同じ条件の負荷テストを行う
+SETTINGS = (
+    ('before', 'no'),
+    ('after', 'yes'),
+)
+
+
+def apply_apache_playbook(tuning_enabled):
+    print(f'ch4_apache.yml(apache_tuning_enabled={tuning_enabled})を実行します：{datetime.datetime.now()}')
+    subprocess.run(
+        ['ansible-playbook', '-i', 'hosts', 'ch4_apache.yml', '-e', f'apache_tuning_enabled={tuning_enabled}'],
+        check=True,
+    )
+
+
+def compare(results):
+    before, after = results['before'], results['after']
+    rows = [('throughput_rps', before['throughput_rps'], after['throughput_rps'])]
+    rows.extend(
+        (f'latency_ms.{key}', before['latency_ms'][key], after['latency_ms'][key])
+        for key in ('p50', 'p95', 'p99'))
+    rows.append(('errors', sum(before['errors'].values()), sum(after['errors'].values())))
+    return '\n'.join(f'{name:<16}{b:>12}{a:>12}' for name, b, a in [('', 'before', 'after'), *rows])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', action='append', help='対象のURL(指定しない場合はaws.jsonのWebサーバー)')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--output', default='bench_apache.json')
+    args = parser.parse_args()
+
+    urls = args.url or find_web_urls()
+    results = {}
+    for label, tuning_enabled in SETTINGS:
+        apply_apache_playbook(tuning_enabled)
+        results[label] = run_load_test(urls, args.concurrency, args.duration)
+
+    print_response('bench apache', compare(results))
+    with open(args.output, mode='w') as f:
+        json.dump(results, f, indent=2)
@@ -1,7 +1,7 @@
 import inspect
 import json
-import boto3
-from util import create_ec2_client, create_ec2_resource, print_response
+from inventory import record_stack
+from util import create_session, create_ec2_client, create_ec2_resource, print_response
 
 
 def create_vpc(ec2_client):
@@ -162,8 +162,7 @@ def describe_route_tables(ec2_client):
 
 if __name__ == '__main__':
     aws = {}
-    # profileを使い分ける場合には、profileをセット
-    session = boto3.Session(profile_name='my-profile')
+    session = create_session()
     # 使用するクライアントとリソースを作成
     client = create_ec2_client(session)
     resource = create_ec2_resource(session)
@@ -207,3 +206,6 @@ if __name__ == '__main__':
     # ここまでのid情報をJSONとして保存
     with open('aws.json', mode='w') as f:
         json.dump(aws, f)
+
+    # VPCの構成をインベントリに反映する
+    record_stack(client, aws)
@@ -1,9 +1,10 @@
+import argparse
 import datetime
 import inspect
 import json
 import os
-import boto3
-from util import create_ec2_client, create_ec2_resource, print_response
+from inventory import record_stack
+from util import create_session, create_ec2_client, create_ec2_resource, print_response
 
 IMAGE_ID = 'ami-3bd3c45c'
 KEY_PAIR_NAME = 'syakyo_aws_network_server2'
@@ -130,7 +131,12 @@ def wait(ec2_client, ec2_instance):
 
 
 if __name__ == '__main__':
-    session = boto3.Session(profile_name='my-profile')
+    parser = argparse.ArgumentParser()
+    # --poolを指定した場合は、pool_instance.pyのプールから停止中のインスタンスを取り出す
+    parser.add_argument('--pool', action='store_true')
+    args = parser.parse_args()
+
+    session = create_session()
     # 使用するクライアントとリソースを作成
     client = create_ec2_client(session)
     resource = create_ec2_resource(session)
@@ -153,21 +159,40 @@ if __name__ == '__main__':
     # modeは8進数表記がわかりやすい：Python3からはprefixが`0o`となった
     os.chmod(KEY_PAIR_FILE, mode=0o400)
 
-    # セキュリティグループを作成する
-    aws['web_security_group_id'] = create_security_group(client, aws['vpc_id'], name='WEB-SG2')
+    # pool_instance.pyとclear_all.pyは実行する時にしか使わないため、このファイルのimportを軽くするようここでimportする
+    from pool_instance import claim_instance, free_private_ip
+
+    pooled = None
+    if args.pool:
+        # プールにあれば、起動してrunningになるまで待つだけで済む
+        pooled = claim_instance(resource, aws['public_subnet_id'], '192.168.1.10', 'Webサーバー2')
+
+    if pooled:
+        # セキュリティグループはプールのインスタンスのものをそのまま使う
+        aws['web_security_group_id'] = pooled['security_group_id']
+        aws['web_instance_id'] = pooled['instance_id']
+    else:
+        # プールに停止中のインスタンスが残っていると、固定のプライベートIPアドレスが使えないため削除しておく
+        free_private_ip(client, aws['public_subnet_id'], '192.168.1.10')
 
-    # セキュリティグループでSSHのポートを開ける
-    authorize_ingress_by_ssh_port(resource, aws['web_security_group_id'])
+        # セキュリティグループを作成する
+        aws['web_security_group_id'] = create_security_group(client, aws['vpc_id'], name='WEB-SG2')
 
-    # EC2を立てる
-    instance = create_ec2_instances(
-        resource, aws['web_security_group_id'], aws['public_subnet_id'], aws['key_pair_name'],
-        is_associate_public_ip=True, private_ip='192.168.1.10', instance_name='Webサーバー2')
-    aws['web_instance_id'] = instance.instance_id
+        # セキュリティグループでSSHのポートを開ける
+        authorize_ingress_by_ssh_port(resource, aws['web_security_group_id'])
 
-    # running & InstanceStatusOkになるまで待つ
-    wait(client, instance)
+        # EC2を立てる
+        instance = create_ec2_instances(
+            resource, aws['web_security_group_id'], aws['public_subnet_id'], aws['key_pair_name'],
+            is_associate_public_ip=True, private_ip='192.168.1.10', instance_name='Webサーバー2')
+        aws['web_instance_id'] = instance.instance_id
+
+        # running & InstanceStatusOkになるまで待つ
+        wait(client, instance)
 
     # ここまでのid情報をJSONとして上書き保存
     with open('aws.json', mode='w') as f:
         json.dump(aws, f)
+
+    # VPCの構成をインベントリに反映する
+    record_stack(client, aws)
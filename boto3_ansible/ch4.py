@@ -1,7 +1,8 @@
 import inspect
 import json
-import boto3
-from util import create_ec2_client, create_ec2_resource, print_response
+from botocore.exceptions import ClientError
+from inventory import record_stack
+from util import create_session, create_ec2_client, create_ec2_resource, print_response
 
 
 def authorize_ingress_by_http_port(ec2_resource, security_group_id):
@@ -26,7 +27,7 @@ def modify_vpc_attribute(ec2_client, vpc_id):
 
 
 if __name__ == '__main__':
-    session = boto3.Session(profile_name='my-profile')
+    session = create_session()
     # 使用するクライアントとリソースを作成
     client = create_ec2_client(session)
     resource = create_ec2_resource(session)
@@ -36,7 +37,15 @@ if __name__ == '__main__':
         aws = json.load(f)
 
     # セキュリティグループでHTTPのポートを開ける
-    authorize_ingress_by_http_port(resource, aws['web_security_group_id'])
+    # プールから取り出したWebサーバーのセキュリティグループでは、すでに開いていることがある
+    try:
+        authorize_ingress_by_http_port(resource, aws['web_security_group_id'])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+            raise
 
     # 「DNSホスト名の編集」を実行する
     modify_vpc_attribute(client, aws['vpc_id'])
+
+    # VPCの構成をインベントリに反映する
+    record_stack(client, aws)
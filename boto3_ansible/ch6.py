@@ -1,9 +1,9 @@
+import argparse
 import inspect
 import json
-import boto3
-from ch2 import create_vpc_subnet, create_subnet_name_tag
-from ch3 import create_security_group, authorize_ingress_by_ssh_port, create_ec2_instances
-from util import create_ec2_client, create_ec2_resource, print_response
+from botocore.exceptions import ClientError
+from inventory import record_stack
+from util import create_session, create_ec2_client, create_ec2_resource, print_response
 
 
 def get_availability_zone_at_public_subnet(ec2_resource, subnet_id):
@@ -37,7 +37,16 @@ def authorize_ingress_by_icmp_port(ec2_resource, security_group_id):
 
 
 if __name__ == '__main__':
-    session = boto3.Session(profile_name='my-profile')
+    # ch2.pyとch3.pyの関数はこのファイルを実行する時にしか使わないため、ここでimportする
+    from ch2 import create_vpc_subnet, create_subnet_name_tag
+    from ch3 import create_security_group, authorize_ingress_by_ssh_port, create_ec2_instances
+
+    parser = argparse.ArgumentParser()
+    # --poolを指定した場合は、pool_instance.pyのプールから停止中のインスタンスを取り出す
+    parser.add_argument('--pool', action='store_true')
+    args = parser.parse_args()
+
+    session = create_session()
     # 使用するクライアントとリソースを作成
     client = create_ec2_client(session)
     resource = create_ec2_resource(session)
@@ -46,37 +55,63 @@ if __name__ == '__main__':
     with open('aws.json', mode='r') as f:
         aws = json.load(f)
 
-    # パブリックサブネットのAvailability Zoneを取得する
-    zone = get_availability_zone_at_public_subnet(resource, aws['public_subnet_id'])
+    # `pool_instance.py release db`でプールに戻した場合は、プライベートサブネットが残っている
+    if 'private_subnet_id' not in aws:
+        # パブリックサブネットのAvailability Zoneを取得する
+        zone = get_availability_zone_at_public_subnet(resource, aws['public_subnet_id'])
+
+        # プライベートサブネットを作る
+        subnet = create_vpc_subnet(resource, aws['vpc_id'], zone, '192.168.2.0/24')
+        aws['private_subnet_id'] = subnet.subnet_id
 
-    # プライベートサブネットを作る
-    subnet = create_vpc_subnet(resource, aws['vpc_id'], zone, '192.168.2.0/24')
-    aws['private_subnet_id'] = subnet.subnet_id
+        # プライベートサブネットに名前をつける
+        create_subnet_name_tag(subnet, 'プライベートサブネット2')
 
-    # プライベートサブネットに名前をつける
-    create_subnet_name_tag(subnet, 'プライベートサブネット2')
+    # pool_instance.pyとclear_all.pyは実行する時にしか使わないため、このファイルのimportを軽くするようここでimportする
+    from pool_instance import claim_instance, free_private_ip
 
-    # セキュリティグループを作成する
-    aws['db_security_group_id'] = create_security_group(client, aws['vpc_id'], name='DB-SG2')
+    pooled = None
+    if args.pool:
+        # プールにあれば、起動してrunningになるまで待つだけで済む
+        pooled = claim_instance(resource, aws['private_subnet_id'], '192.168.2.10', 'DBサーバー2')
 
-    # セキュリティグループでSSHのポートを開ける
-    authorize_ingress_by_ssh_port(resource, aws['db_security_group_id'])
+    if pooled:
+        # セキュリティグループはプールのインスタンスのものをそのまま使う
+        aws['db_security_group_id'] = pooled['security_group_id']
+        aws['db_instance_id'] = pooled['instance_id']
+    else:
+        # プールに停止中のインスタンスが残っていると、固定のプライベートIPアドレスが使えないため削除しておく
+        free_private_ip(client, aws['private_subnet_id'], '192.168.2.10')
 
-    # セキュリティグループでMySQLのポートを開ける
-    authorize_ingress_by_mysql_port(resource, aws['db_security_group_id'])
+        # セキュリティグループを作成する
+        aws['db_security_group_id'] = create_security_group(client, aws['vpc_id'], name='DB-SG2')
 
-    # EC2を立てる
-    instance = create_ec2_instances(
-        resource, aws['db_security_group_id'], aws['private_subnet_id'], aws['key_pair_name'],
-        is_associate_public_ip=False, private_ip='192.168.2.10', instance_name='DBサーバー2')
-    aws['db_instance_id'] = instance.instance_id
+        # セキュリティグループでSSHのポートを開ける
+        authorize_ingress_by_ssh_port(resource, aws['db_security_group_id'])
 
-    # セキュリティグループでICMPのポートを開ける
-    authorize_ingress_by_icmp_port(resource, aws['db_security_group_id'])
+        # セキュリティグループでMySQLのポートを開ける
+        authorize_ingress_by_mysql_port(resource, aws['db_security_group_id'])
+
+        # EC2を立てる
+        instance = create_ec2_instances(
+            resource, aws['db_security_group_id'], aws['private_subnet_id'], aws['key_pair_name'],
+            is_associate_public_ip=False, private_ip='192.168.2.10', instance_name='DBサーバー2')
+        aws['db_instance_id'] = instance.instance_id
+
+        # セキュリティグループでICMPのポートを開ける
+        authorize_ingress_by_icmp_port(resource, aws['db_security_group_id'])
 
     # WebサーバーでもICMPのポートを開ける
-    authorize_ingress_by_icmp_port(resource, aws['web_security_group_id'])
+    # プールから取り出したWebサーバーのセキュリティグループでは、すでに開いていることがある
+    try:
+        authorize_ingress_by_icmp_port(resource, aws['web_security_group_id'])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+            raise
 
     # ここまでのid情報をJSONとして上書き保存
     with open('aws.json', mode='w') as f:
         json.dump(aws, f)
+
+    # VPCの構成をインベントリに反映する
+    record_stack(client, aws)
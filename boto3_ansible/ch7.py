@@ -1,8 +1,9 @@
+import argparse
 import datetime
 import inspect
 import json
-import boto3
-from util import create_ec2_client, create_ec2_resource, print_response
+from inventory import record_stack
+from util import create_session, create_ec2_client, create_ec2_resource, print_response
 
 
 def create_elastic_ip(ec2_client):
@@ -15,7 +16,7 @@ def create_elastic_ip(ec2_client):
 
 def create_nat_gateway(ec2_client, allocation_id, subnet_id):
     # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Client.create_nat_gateway
-    response = client.create_nat_gateway(
+    response = ec2_client.create_nat_gateway(
         AllocationId=allocation_id,
         SubnetId=subnet_id,
     )
@@ -69,7 +70,13 @@ def create_nat_gateway_route_in_route_table(ec2_resource, route_table_id, nat_ga
 
 
 if __name__ == '__main__':
-    session = boto3.Session(profile_name='my-profile')
+    parser = argparse.ArgumentParser()
+    # --poolを指定した場合は、pool_nat.pyのプールからNATゲートウェイを取り出す
+    parser.add_argument('--pool', action='store_true')
+    parser.add_argument('--pool-size', type=int, default=1)
+    args = parser.parse_args()
+
+    session = create_session()
     # 使用するクライアントとリソースを作成
     client = create_ec2_client(session)
     resource = create_ec2_resource(session)
@@ -78,14 +85,27 @@ if __name__ == '__main__':
     with open('aws.json', mode='r') as f:
         aws = json.load(f)
 
-    # Elastic IPを取得する
-    aws['allocation_id'] = create_elastic_ip(client)
+    pooled = None
+    if args.pool:
+        # pool_nat.pyはこのファイルをimportしているため、循環importを避けてここでimportする
+        from pool_nat import claim_nat_gateway, refill_pool_in_background
+        # availableなNATゲートウェイがプールにあれば、作成と待ちを省略できる
+        pooled = claim_nat_gateway(client, aws['public_subnet_id'])
+        # 取り出した分は、バックグラウンドで補充しておく
+        refill_pool_in_background(aws['public_subnet_id'], args.pool_size)
+
+    if pooled:
+        aws['allocation_id'] = pooled['allocation_id']
+        aws['nat_gateway_id'] = pooled['nat_gateway_id']
+    else:
+        # Elastic IPを取得する
+        aws['allocation_id'] = create_elastic_ip(client)
 
-    # パブリックサブネットにNATゲートウェイを置く
-    aws['nat_gateway_id'] = create_nat_gateway(client, aws['allocation_id'], aws['public_subnet_id'])
+        # パブリックサブネットにNATゲートウェイを置く
+        aws['nat_gateway_id'] = create_nat_gateway(client, aws['allocation_id'], aws['public_subnet_id'])
 
-    # NATゲートウェイはすぐに使うことができないため、availableになるまで待つ
-    wait_nat_gateway_available(client, aws['nat_gateway_id'])
+        # NATゲートウェイはすぐに使うことができないため、availableになるまで待つ
+        wait_nat_gateway_available(client, aws['nat_gateway_id'])
 
     # NATゲートウェイのエントリを追加するため、メインのルートテーブルのIDを取得する
     aws['main_route_table_id'] = describe_main_route_tables(client, aws['vpc_id'])
@@ -96,3 +116,6 @@ if __name__ == '__main__':
     # ここまでのid情報をJSONとして上書き保存
     with open('aws.json', mode='w') as f:
         json.dump(aws, f)
+
+    # VPCの構成をインベントリに反映する
+    record_stack(client, aws)
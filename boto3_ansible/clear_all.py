@@ -1,10 +1,8 @@
 import inspect
 import json
 import os
-import boto3
-from ch3 import KEY_PAIR_FILE
-from clear_ch2 import delete_each_vpc_items
-from util import create_ec2_client, create_ec2_resource, print_response
+from inventory import forget_stack
+from util import create_session, create_ec2_client, create_ec2_resource, print_response
 
 
 def delete_route_from_main_route_table(ec2_client, main_route_table_id):
@@ -64,8 +62,13 @@ def delete_key_pair(ec2_client, key_pair_name):
 
 
 if __name__ == '__main__':
+    # pool_nat.pyやpool_instance.pyはこのファイルの関数だけを使うため、
+    # 削除処理でしか使わないch3.pyとclear_ch2.pyはここでimportし、それらのimportを軽くしておく
+    from ch3 import KEY_PAIR_FILE
+    from clear_ch2 import delete_each_vpc_items
+
     # Profileをロード
-    session = boto3.Session(profile_name='my-profile')
+    session = create_session()
     # クライアントとリソースを作っておく
     client = create_ec2_client(session)
     resource = create_ec2_resource(session)
@@ -74,21 +77,36 @@ if __name__ == '__main__':
         aws = json.load(f)
 
     # --- Chapter 7 --->
-    # VPC領域2のメインのルートテーブルからNATゲートウェイのエントリを削除する
-    delete_route_from_main_route_table(client, aws['main_route_table_id'])
+    # `pool_nat.py release`でプールに戻した場合は、NATゲートウェイのエントリがない
+    if 'nat_gateway_id' in aws:
+        # VPC領域2のメインのルートテーブルからNATゲートウェイのエントリを削除する
+        delete_route_from_main_route_table(client, aws['main_route_table_id'])
+
+        # パブリックサブネットからNATゲートウェイを削除する
+        delete_nat_gateway(client, aws['nat_gateway_id'])
 
-    # パブリックサブネットからNATゲートウェイを削除する
-    delete_nat_gateway(client, aws['nat_gateway_id'])
+        # Elastic IPを削除する
+        delete_elastic_ip(client, aws['allocation_id'])
 
-    # Elastic IPを削除する
-    delete_elastic_ip(client, aws['allocation_id'])
+    # パブリックサブネットを削除できるよう、プールに残っているNATゲートウェイとElastic IPを削除する
+    # ch7の--poolで始めたバックグラウンドの補充が作成中のものも、作成を待ってから削除する
+    # pool_nat.pyはこのファイルをimportしているため、循環importを避けてここでimportする
+    from pool_nat import drain_pool as drain_nat_pool
+    drain_nat_pool(client, aws['public_subnet_id'])
 
     # --- Chapter 6 --->
-    # DBサーバーのEC2インスタンスを削除する
-    terminate_instances_with_wait(client, aws['db_instance_id'])
+    # `pool_instance.py release db`でプールに戻した場合は、DBサーバーのエントリがない
+    if 'db_instance_id' in aws:
+        # DBサーバーのEC2インスタンスを削除する
+        terminate_instances_with_wait(client, aws['db_instance_id'])
+
+        # DBサーバーのセキュリティグループを削除する
+        delete_security_group(client, aws['db_security_group_id'])
 
-    # DBサーバーのセキュリティグループを削除する
-    delete_security_group(client, aws['db_security_group_id'])
+    # プライベートサブネットを削除できるよう、プールに残っているインスタンスとセキュリティグループを削除する
+    # pool_instance.pyはこのファイルをimportしているため、循環importを避けてここでimportする
+    from pool_instance import drain_pool as drain_instance_pool
+    drain_instance_pool(client, aws['private_subnet_id'])
 
     # プライベートサブネットを削除する
     delete_subnet(client, aws['private_subnet_id'])
@@ -96,11 +114,16 @@ if __name__ == '__main__':
     # Chapter4では、IDがあるようなものを作成していないので、作業を省略
 
     # --- Chapter 3 --->
-    # WebサーバーのEC2インスタンスを削除する
-    terminate_instances_with_wait(client, aws['web_instance_id'])
+    # `pool_instance.py release web`でプールに戻した場合は、Webサーバーのエントリがない
+    if 'web_instance_id' in aws:
+        # WebサーバーのEC2インスタンスを削除する
+        terminate_instances_with_wait(client, aws['web_instance_id'])
 
-    # Webサーバーのセキュリティグループを削除する
-    delete_security_group(client, aws['web_security_group_id'])
+        # Webサーバーのセキュリティグループを削除する
+        delete_security_group(client, aws['web_security_group_id'])
+
+    # パブリックサブネットのプールに残っているインスタンスとセキュリティグループを削除する
+    drain_instance_pool(client, aws['public_subnet_id'])
 
     # キーペアを削除する
     delete_key_pair(client, aws['key_pair_name'])
@@ -116,4 +139,5 @@ if __name__ == '__main__':
     # それぞれのオブジェクトを、作成したのとは逆順に削除する
     delete_each_vpc_items(client, aws)
 
-
+    # インベントリからも削除する
+    forget_stack(aws['vpc_id'])
@@ -1,6 +1,6 @@
 import json
-import boto3
-from util import create_ec2_client, create_ec2_resource
+from inventory import forget_stack
+from util import create_session, create_ec2_client, create_ec2_resource
 
 
 def delete_route_from_route_table(ec2_client, route_table_id):
@@ -70,12 +70,12 @@ def delete_each_vpc_items(ec2_client, aws):
     delete_subnet(ec2_client, aws['public_subnet_id'])
 
     # VPC領域の削除
-    delete_vpc(ec2_client, aws_keys['vpc_id'])
+    delete_vpc(ec2_client, aws['vpc_id'])
 
 
 if __name__ == '__main__':
     # Profileをロード
-    session = boto3.Session(profile_name='my-profile')
+    session = create_session()
     # クライアントとリソースを作っておく
     client = create_ec2_client(session)
     resource = create_ec2_resource(session)
@@ -86,6 +86,9 @@ if __name__ == '__main__':
     # それぞれのオブジェクトを、作成したのとは逆順に削除する場合
     delete_each_vpc_items(client, aws_keys)
 
+    # インベントリからも削除する
+    forget_stack(aws_keys['vpc_id'])
+
     # GUIではVPCを削除するとそれぞれのオブジェクトも自動的に削除されるが、boto3だとエラーで削除できない
     # botocore.exceptions.ClientError: An error occurred (DependencyViolation) when calling the DeleteVpc operation:
     # The vpc 'vpc-a781dac3' has dependencies and cannot be deleted.
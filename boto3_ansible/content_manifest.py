@@ -0,0 +1,74 @@
+import argparse
+import hashlib
+import json
+import os
+
+# ファイルを読み込む単位
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, mode='rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def build_manifest(content_dir):
+    # { 相対パス: {sha256, size} }
+    manifest = {}
+    for root, dirs, files in os.walk(content_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            manifest[os.path.relpath(path, content_dir)] = {
+                'sha256': hash_file(path),
+                'size': os.path.getsize(path),
+            }
+    return manifest
+
+
+def create_release_id(manifest):
+    # 内容が同じならリリースIDも同じになるため、同じ内容の再デプロイやロールバックでは転送しなくて済む
+    payload = json.dumps(manifest, sort_keys=True).encode()
+    return hashlib.sha256(payload).hexdigest()[:16]
+
+
+def diff_manifests(old, new):
+    changed = sorted(path for path, entry in new.items() if old.get(path) != entry)
+    removed = sorted(path for path in old if path not in new)
+    return changed, removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('content_dir')
+    parser.add_argument('--output', required=True, help='マニフェストを保存するJSONファイル')
+    parser.add_argument('--previous', help='比較する前回のマニフェストのJSONファイル')
+    args = parser.parse_args()
+
+    # --outputと同じファイルを指定できるよう、前回のマニフェストは先に読み込んでおく
+    previous = None
+    if args.previous and os.path.exists(args.previous):
+        with open(args.previous, mode='r') as f:
+            previous = json.load(f)['files']
+
+    manifest = build_manifest(args.content_dir)
+    release_id = create_release_id(manifest)
+    with open(args.output, mode='w') as f:
+        json.dump({'release': release_id, 'files': manifest}, f, indent=2, sort_keys=True)
+
+    summary = {
+        'release': release_id,
+        'files': len(manifest),
+        'bytes': sum(entry['size'] for entry in manifest.values()),
+    }
+    if previous is not None:
+        changed, removed = diff_manifests(previous, manifest)
+        summary['changed'] = changed
+        summary['removed'] = removed
+        summary['changed_bytes'] = sum(manifest[path]['size'] for path in changed)
+
+    # ansible-playbookのfrom_jsonで読めるよう、標準出力はJSONだけにする
+    print(json.dumps(summary))
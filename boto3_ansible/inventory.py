@@ -0,0 +1,393 @@
+import argparse
+import contextlib
+import inspect
+import json
+import sqlite3
+from util import create_session, create_ec2_client, print_response
+
+# aws.jsonは1つのスタックのIDしか持てないため、AWS上の構成をSQLiteにも保存して検索できるようにする
+# スタック名は、VPCの`stack`タグの値、タグがなければVPC IDとする
+INVENTORY_FILE = 'inventory.db'
+
+# テーブルの定義を変えた場合は上げる。古いinventory.dbは作り直す(refreshで再取得できる)
+SCHEMA_VERSION = 2
+
+# describe系のFiltersのValuesに指定できる数の上限
+MAX_FILTER_VALUES = 200
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS vpcs (
+    vpc_id TEXT PRIMARY KEY,
+    stack TEXT NOT NULL,
+    cidr_block TEXT,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS subnets (
+    subnet_id TEXT PRIMARY KEY,
+    stack TEXT NOT NULL,
+    vpc_id TEXT NOT NULL,
+    availability_zone TEXT,
+    cidr_block TEXT,
+    route_table_id TEXT,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS route_tables (
+    route_table_id TEXT PRIMARY KEY,
+    stack TEXT NOT NULL,
+    vpc_id TEXT NOT NULL,
+    is_main INTEGER NOT NULL,
+    has_internet_gateway INTEGER NOT NULL,
+    has_nat_gateway INTEGER NOT NULL,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS security_groups (
+    group_id TEXT PRIMARY KEY,
+    stack TEXT NOT NULL,
+    vpc_id TEXT NOT NULL,
+    group_name TEXT
+);
+CREATE TABLE IF NOT EXISTS security_group_rules (
+    group_id TEXT NOT NULL,
+    stack TEXT NOT NULL,
+    vpc_id TEXT NOT NULL,
+    ip_protocol TEXT,
+    from_port INTEGER,
+    to_port INTEGER,
+    cidr_ip TEXT
+);
+CREATE TABLE IF NOT EXISTS instances (
+    instance_id TEXT PRIMARY KEY,
+    stack TEXT NOT NULL,
+    vpc_id TEXT NOT NULL,
+    subnet_id TEXT,
+    state TEXT,
+    private_ip TEXT,
+    public_ip TEXT,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS nat_gateways (
+    nat_gateway_id TEXT PRIMARY KEY,
+    stack TEXT NOT NULL,
+    vpc_id TEXT NOT NULL,
+    subnet_id TEXT,
+    state TEXT,
+    allocation_id TEXT,
+    private_ip TEXT,
+    public_ip TEXT
+);
+CREATE TABLE IF NOT EXISTS elastic_ips (
+    allocation_id TEXT PRIMARY KEY,
+    stack TEXT NOT NULL,
+    vpc_id TEXT NOT NULL,
+    network_interface_id TEXT,
+    private_ip TEXT,
+    public_ip TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (
+    resource_id TEXT NOT NULL,
+    stack TEXT NOT NULL,
+    vpc_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT
+);
+
+CREATE INDEX IF NOT EXISTS vpcs_stack ON vpcs (stack);
+CREATE INDEX IF NOT EXISTS subnets_stack ON subnets (stack);
+CREATE INDEX IF NOT EXISTS subnets_vpc_id ON subnets (vpc_id);
+CREATE INDEX IF NOT EXISTS route_tables_stack ON route_tables (stack);
+CREATE INDEX IF NOT EXISTS route_tables_vpc_id ON route_tables (vpc_id);
+CREATE INDEX IF NOT EXISTS security_groups_stack ON security_groups (stack);
+CREATE INDEX IF NOT EXISTS security_groups_vpc_id ON security_groups (vpc_id);
+CREATE INDEX IF NOT EXISTS security_group_rules_group_id ON security_group_rules (group_id);
+CREATE INDEX IF NOT EXISTS security_group_rules_stack ON security_group_rules (stack);
+CREATE INDEX IF NOT EXISTS security_group_rules_vpc_id ON security_group_rules (vpc_id);
+CREATE INDEX IF NOT EXISTS instances_stack ON instances (stack);
+CREATE INDEX IF NOT EXISTS instances_vpc_id ON instances (vpc_id);
+CREATE INDEX IF NOT EXISTS instances_subnet_id ON instances (subnet_id);
+CREATE INDEX IF NOT EXISTS instances_private_ip ON instances (private_ip);
+CREATE INDEX IF NOT EXISTS instances_public_ip ON instances (public_ip);
+CREATE INDEX IF NOT EXISTS nat_gateways_stack ON nat_gateways (stack);
+CREATE INDEX IF NOT EXISTS nat_gateways_vpc_id ON nat_gateways (vpc_id);
+CREATE INDEX IF NOT EXISTS nat_gateways_private_ip ON nat_gateways (private_ip);
+CREATE INDEX IF NOT EXISTS nat_gateways_public_ip ON nat_gateways (public_ip);
+CREATE INDEX IF NOT EXISTS elastic_ips_stack ON elastic_ips (stack);
+CREATE INDEX IF NOT EXISTS elastic_ips_vpc_id ON elastic_ips (vpc_id);
+CREATE INDEX IF NOT EXISTS elastic_ips_private_ip ON elastic_ips (private_ip);
+CREATE INDEX IF NOT EXISTS elastic_ips_public_ip ON elastic_ips (public_ip);
+CREATE INDEX IF NOT EXISTS tags_stack ON tags (stack);
+CREATE INDEX IF NOT EXISTS tags_vpc_id ON tags (vpc_id);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value);
+CREATE INDEX IF NOT EXISTS tags_resource_id ON tags (resource_id);
+'''
+
+# VPCを入れ替える時に、行を削除するテーブル
+# 同じstackタグのVPCが複数あっても、他のVPCの行を消さないよう、すべてのテーブルにvpc_idを持たせる
+TABLES = (
+    'vpcs', 'subnets', 'route_tables', 'security_groups', 'security_group_rules',
+    'instances', 'nat_gateways', 'elastic_ips', 'tags',
+)
+
+
+def connect(path=INVENTORY_FILE):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+        conn.executescript(''.join(f'DROP TABLE IF EXISTS {table};' for table in TABLES))
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def describe_all(method, result_key, **kwargs):
+    # NextTokenがある間は続けて取得する
+    # boto3 1.4.5では一部のdescribe系にしかpaginatorがないため、NextTokenを直接扱う
+    while True:
+        response = method(**kwargs)
+        yield from response.get(result_key, [])
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+
+
+def describe_all_in_vpcs(method, result_key, vpc_ids, filter_key='Filters'):
+    # VPCのIDを、FiltersのValuesの上限ごとに分けて取得する
+    # describe_nat_gatewaysだけは、引数名がFiltersではなくFilterになっている
+    for i in range(0, len(vpc_ids), MAX_FILTER_VALUES):
+        yield from describe_all(
+            method, result_key,
+            **{filter_key: [{
+                'Name': 'vpc-id',
+                'Values': vpc_ids[i:i + MAX_FILTER_VALUES],
+            }]}
+        )
+
+
+def find_tag(tags, key):
+    for tag in tags or []:
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+
+def insert_tags(conn, stack, vpc_id, resource_id, tags):
+    conn.executemany(
+        'INSERT INTO tags (resource_id, stack, vpc_id, key, value) VALUES (?, ?, ?, ?, ?)',
+        [(resource_id, stack, vpc_id, tag['Key'], tag['Value']) for tag in tags or []],
+    )
+
+
+def delete_vpcs(conn, vpc_ids):
+    # stackタグで削除すると、同じタグの他のVPCや、タグを変更する前の行の扱いを誤るため、VPC IDで削除する
+    for table in TABLES:
+        conn.executemany(f'DELETE FROM {table} WHERE vpc_id = ?', [(vpc_id,) for vpc_id in vpc_ids])
+
+
+def refresh(conn, ec2_client, vpc_ids=None):
+    # 指定したVPC(指定がなければリージョンの全VPC)の構成を、リソースの種類ごとにまとめて取得して入れ替える
+    # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Client.describe_vpcs
+    if vpc_ids is None:
+        vpcs = list(describe_all(ec2_client.describe_vpcs, 'Vpcs'))
+    else:
+        vpcs = list(describe_all(ec2_client.describe_vpcs, 'Vpcs', VpcIds=vpc_ids))
+    vpc_ids = [vpc['VpcId'] for vpc in vpcs]
+    stacks = {vpc['VpcId']: find_tag(vpc.get('Tags'), 'stack') or vpc['VpcId'] for vpc in vpcs}
+
+    # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Client.describe_subnets
+    subnets = list(describe_all_in_vpcs(ec2_client.describe_subnets, 'Subnets', vpc_ids))
+    # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Client.describe_route_tables
+    route_tables = list(describe_all_in_vpcs(ec2_client.describe_route_tables, 'RouteTables', vpc_ids))
+    # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Client.describe_security_groups
+    security_groups = list(describe_all_in_vpcs(ec2_client.describe_security_groups, 'SecurityGroups', vpc_ids))
+    # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Client.describe_instances
+    reservations = list(describe_all_in_vpcs(ec2_client.describe_instances, 'Reservations', vpc_ids))
+    # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Client.describe_nat_gateways
+    nat_gateways = list(describe_all_in_vpcs(
+        ec2_client.describe_nat_gateways, 'NatGateways', vpc_ids, filter_key='Filter'))
+    # Elastic IPはVPCで絞り込めないため、全件取得してネットワークインタフェースでVPCと結びつける
+    # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Client.describe_addresses
+    addresses = ec2_client.describe_addresses(Filters=[{'Name': 'domain', 'Values': ['vpc']}])['Addresses']
+
+    # サブネットに明示的に関連付けたルートテーブルがなければ、メインのルートテーブルが使われる
+    main_route_table_ids = {}
+    subnet_route_table_ids = {}
+    for route_table in route_tables:
+        for association in route_table.get('Associations', []):
+            if association.get('Main'):
+                main_route_table_ids[route_table['VpcId']] = route_table['RouteTableId']
+            elif association.get('SubnetId'):
+                subnet_route_table_ids[association['SubnetId']] = route_table['RouteTableId']
+
+    vpc_ids_by_eni = {}
+    with conn:
+        delete_vpcs(conn, vpc_ids)
+
+        for vpc in vpcs:
+            stack = stacks[vpc['VpcId']]
+            conn.execute(
+                'INSERT INTO vpcs (vpc_id, stack, cidr_block, name) VALUES (?, ?, ?, ?)',
+                (vpc['VpcId'], stack, vpc['CidrBlock'], find_tag(vpc.get('Tags'), 'Name')))
+            insert_tags(conn, stack, vpc['VpcId'], vpc['VpcId'], vpc.get('Tags'))
+
+        for subnet in subnets:
+            stack = stacks[subnet['VpcId']]
+            route_table_id = subnet_route_table_ids.get(subnet['SubnetId'], main_route_table_ids.get(subnet['VpcId']))
+            conn.execute(
+                'INSERT INTO subnets (subnet_id, stack, vpc_id, availability_zone, cidr_block, route_table_id, name) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (subnet['SubnetId'], stack, subnet['VpcId'], subnet['AvailabilityZone'], subnet['CidrBlock'],
+                 route_table_id, find_tag(subnet.get('Tags'), 'Name')))
+            insert_tags(conn, stack, subnet['VpcId'], subnet['SubnetId'], subnet.get('Tags'))
+
+        for route_table in route_tables:
+            stack = stacks[route_table['VpcId']]
+            routes = route_table.get('Routes', [])
+            conn.execute(
+                'INSERT INTO route_tables '
+                '(route_table_id, stack, vpc_id, is_main, has_internet_gateway, has_nat_gateway, name) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (route_table['RouteTableId'], stack, route_table['VpcId'],
+                 main_route_table_ids.get(route_table['VpcId']) == route_table['RouteTableId'],
+                 any(r.get('GatewayId', '').startswith('igw-') for r in routes),
+                 any('NatGatewayId' in r for r in routes),
+                 find_tag(route_table.get('Tags'), 'Name')))
+            insert_tags(conn, stack, route_table['VpcId'], route_table['RouteTableId'], route_table.get('Tags'))
+
+        for security_group in security_groups:
+            stack = stacks[security_group['VpcId']]
+            conn.execute(
+                'INSERT INTO security_groups (group_id, stack, vpc_id, group_name) VALUES (?, ?, ?, ?)',
+                (security_group['GroupId'], stack, security_group['VpcId'], security_group['GroupName']))
+            conn.executemany(
+                'INSERT INTO security_group_rules '
+                '(group_id, stack, vpc_id, ip_protocol, from_port, to_port, cidr_ip) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(security_group['GroupId'], stack, security_group['VpcId'],
+                  p['IpProtocol'], p.get('FromPort'), p.get('ToPort'), r['CidrIp'])
+                 for p in security_group.get('IpPermissions', []) for r in p.get('IpRanges', [])])
+            insert_tags(
+                conn, stack, security_group['VpcId'], security_group['GroupId'], security_group.get('Tags'))
+
+        for reservation in reservations:
+            for instance in reservation['Instances']:
+                # terminatedのインスタンスはVPCの情報を持たない
+                if 'VpcId' not in instance:
+                    continue
+                stack = stacks[instance['VpcId']]
+                conn.execute(
+                    'INSERT INTO instances '
+                    '(instance_id, stack, vpc_id, subnet_id, state, private_ip, public_ip, name) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (instance['InstanceId'], stack, instance['VpcId'], instance.get('SubnetId'),
+                     instance['State']['Name'], instance.get('PrivateIpAddress'), instance.get('PublicIpAddress'),
+                     find_tag(instance.get('Tags'), 'Name')))
+                insert_tags(conn, stack, instance['VpcId'], instance['InstanceId'], instance.get('Tags'))
+                for network_interface in instance.get('NetworkInterfaces', []):
+                    vpc_ids_by_eni[network_interface['NetworkInterfaceId']] = instance['VpcId']
+
+        for nat_gateway in nat_gateways:
+            stack = stacks[nat_gateway['VpcId']]
+            address = (nat_gateway.get('NatGatewayAddresses') or [{}])[0]
+            conn.execute(
+                'INSERT INTO nat_gateways '
+                '(nat_gateway_id, stack, vpc_id, subnet_id, state, allocation_id, private_ip, public_ip) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (nat_gateway['NatGatewayId'], stack, nat_gateway['VpcId'], nat_gateway['SubnetId'],
+                 nat_gateway['State'], address.get('AllocationId'), address.get('PrivateIp'),
+                 address.get('PublicIp')))
+            if 'NetworkInterfaceId' in address:
+                vpc_ids_by_eni[address['NetworkInterfaceId']] = nat_gateway['VpcId']
+
+        for address in addresses:
+            vpc_id = vpc_ids_by_eni.get(address.get('NetworkInterfaceId'))
+            if vpc_id is None:
+                continue
+            conn.execute(
+                'INSERT INTO elastic_ips '
+                '(allocation_id, stack, vpc_id, network_interface_id, private_ip, public_ip) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (address['AllocationId'], stacks[vpc_id], vpc_id, address['NetworkInterfaceId'],
+                 address.get('PrivateIpAddress'), address['PublicIp']))
+
+    print_response(inspect.getframeinfo(inspect.currentframe())[2], sorted(set(stacks.values())))
+
+
+def record_stack(ec2_client, aws):
+    # 各chapterの最後に呼び出し、aws.jsonのVPCの構成をインベントリに反映する
+    with contextlib.closing(connect()) as conn:
+        refresh(conn, ec2_client, [aws['vpc_id']])
+
+
+def forget_stack(vpc_id):
+    # VPCを削除した後は、インベントリからも削除する
+    with contextlib.closing(connect()) as conn, conn:
+        delete_vpcs(conn, [vpc_id])
+
+
+def find_instances_in_private_subnets(conn, stack):
+    # インターネットゲートウェイへのルートがないルートテーブルを使うサブネットを、プライベートサブネットとする
+    return conn.execute(
+        'SELECT i.* FROM instances i '
+        'JOIN subnets s ON s.subnet_id = i.subnet_id '
+        'JOIN route_tables r ON r.route_table_id = s.route_table_id '
+        'WHERE i.stack = ? AND r.has_internet_gateway = 0',
+        (stack,)).fetchall()
+
+
+def find_owners_by_ip(conn, ip):
+    # 同じスクリプトで作ったスタックはプライベートIPアドレスが同じになるため、該当するものをすべて返す
+    return conn.execute(
+        "SELECT stack, vpc_id, 'instance' AS kind, instance_id AS resource_id FROM instances "
+        'WHERE private_ip = ?1 OR public_ip = ?1 '
+        "UNION ALL SELECT stack, vpc_id, 'nat_gateway', nat_gateway_id FROM nat_gateways "
+        'WHERE private_ip = ?1 OR public_ip = ?1 '
+        "UNION ALL SELECT stack, vpc_id, 'elastic_ip', allocation_id FROM elastic_ips "
+        'WHERE private_ip = ?1 OR public_ip = ?1',
+        (ip,)).fetchall()
+
+
+def find_resources_by_tag(conn, key, value):
+    return conn.execute(
+        'SELECT stack, resource_id FROM tags WHERE key = ? AND value = ?',
+        (key, value)).fetchall()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    refresh_parser = subparsers.add_parser('refresh')
+    # --allを指定した場合は、aws.jsonのVPCだけでなく、リージョンの全VPCを取得する
+    refresh_parser.add_argument('--all', action='store_true')
+    private_parser = subparsers.add_parser('private-instances')
+    private_parser.add_argument('stack')
+    owner_parser = subparsers.add_parser('owner')
+    owner_parser.add_argument('ip')
+    tag_parser = subparsers.add_parser('tag')
+    tag_parser.add_argument('key')
+    tag_parser.add_argument('value')
+    args = parser.parse_args()
+
+    with contextlib.closing(connect()) as conn:
+        if args.command == 'refresh':
+            session = create_session()
+            client = create_ec2_client(session)
+            if args.all:
+                refresh(conn, client)
+            else:
+                with open('aws.json', mode='r') as f:
+                    aws = json.load(f)
+                refresh(conn, client, [aws['vpc_id']])
+
+        elif args.command == 'private-instances':
+            rows = find_instances_in_private_subnets(conn, args.stack)
+            print_response(args.command, [dict(row) for row in rows])
+
+        elif args.command == 'owner':
+            rows = find_owners_by_ip(conn, args.ip)
+            print_response(args.command, [dict(row) for row in rows])
+
+        elif args.command == 'tag':
+            rows = find_resources_by_tag(conn, args.key, args.value)
+            print_response(args.command, [dict(row) for row in rows])
+
+        else:
+            parser.print_help()
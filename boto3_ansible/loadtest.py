@@ -0,0 +1,301 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import datetime
+import http.server
+import json
+import socketserver
+import threading
+import urllib.parse
+from inventory import connect
+from util import print_response
+
+# 接続ごとにこの時間応答がなければエラーとする
+DEFAULT_TIMEOUT_SECONDS = 10
+# 接続できなかった場合に、次の接続まで待つ時間(失敗が続くと倍にしていき、上限で止める)
+# 待たずに繰り返すと、サーバーが落ちている間にエラーを数えるだけのビジーループになってしまう
+CONNECT_BACKOFF_SECONDS = 0.05
+MAX_CONNECT_BACKOFF_SECONDS = 2
+
+
+class Histogram:
+    # HdrHistogramと同じく、2のべき乗ごとの区間を同じ数のバケットに分けて記録する
+    # 値の大きさによらず相対誤差が2 / 2**sub_bucket_bits以下になり、メモリも値の範囲の対数にしか比例しない
+    def __init__(self, sub_bucket_bits=7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = collections.Counter()
+        self.total_count = 0
+        self.total_value = 0
+        self.max_value = 0
+
+    def _bucket(self, value):
+        shift = max(value.bit_length() - self.sub_bucket_bits, 0)
+        return shift, value >> shift
+
+    def record(self, value):
+        value = int(value)
+        self.counts[self._bucket(value)] += 1
+        self.total_count += 1
+        self.total_value += value
+        self.max_value = max(self.max_value, value)
+
+    def value_at_percentile(self, percentile):
+        if self.total_count == 0:
+            return 0
+        target = max(int(self.total_count * percentile / 100 + 0.5), 1)
+        count = 0
+        for shift, sub_bucket in sorted(self.counts):
+            count += self.counts[(shift, sub_bucket)]
+            if count >= target:
+                # バケット内で最も大きい値を返す(HdrHistogramのhighestEquivalentValue)
+                return min(((sub_bucket + 1) << shift) - 1, self.max_value)
+        return self.max_value
+
+    def mean(self):
+        return self.total_value / self.total_count if self.total_count else 0
+
+
+class LocalHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-Aliveで接続を使い回せるよう、HTTP/1.1で応答する
+    protocol_version = 'HTTP/1.1'
+    # ヘッダとボディを別々に書き込むため、Nagleアルゴリズムと遅延ACKで応答が40ms待たされないようにする
+    disable_nagle_algorithm = True
+    body = b'<html><body><h1>It works!</h1></body></html>\n'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    # 同時接続数を増やした場合に、接続が待たされないようにする
+    request_queue_size = 1024
+
+
+@contextlib.contextmanager
+def run_local_server():
+    # Webサーバーを立てずに試せるよう、ローカルにHTTPサーバーを立てる
+    server = LocalServer(('127.0.0.1', 0), LocalHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def find_web_urls(stack=None):
+    # AWSを呼び出さずに、インベントリからWebサーバーのパブリックIPアドレスを取得する
+    # stackを指定しない場合は、aws.jsonのWebサーバーを対象とする
+    with contextlib.closing(connect()) as conn:
+        if stack is None:
+            with open('aws.json', mode='r') as f:
+                aws = json.load(f)
+            rows = conn.execute(
+                'SELECT public_ip FROM instances WHERE instance_id = ?', (aws['web_instance_id'],)).fetchall()
+        else:
+            # インターネットゲートウェイへのルートがあるサブネットで、起動しているインスタンスを対象とする
+            rows = conn.execute(
+                'SELECT i.public_ip FROM instances i '
+                'JOIN subnets s ON s.subnet_id = i.subnet_id '
+                'JOIN route_tables r ON r.route_table_id = s.route_table_id '
+                "WHERE i.stack = ? AND i.state = 'running' AND i.public_ip IS NOT NULL "
+                'AND r.has_internet_gateway = 1',
+                (stack,)).fetchall()
+    return [f'http://{row["public_ip"]}/' for row in rows if row['public_ip']]
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError('接続が閉じられました')
+    version, status = status_line.split()[:2]
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+
+    is_keep_alive = version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+    if 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            await reader.readexactly(size + 2)
+    else:
+        # 長さがわからない場合は、接続が閉じられるまで読む
+        await reader.read()
+        is_keep_alive = False
+
+    return int(status), is_keep_alive
+
+
+class LoadTest:
+    def __init__(self, urls, concurrency, duration, rate=None, max_requests=None, timeout=DEFAULT_TIMEOUT_SECONDS):
+        self.urls = [urllib.parse.urlsplit(url) for url in urls]
+        self.concurrency = concurrency
+        self.duration = duration
+        self.rate = rate
+        self.max_requests = max_requests
+        self.timeout = timeout
+
+        self.histogram = Histogram()
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+        self.connections = 0
+        self.sent = 0
+        self.started_at = None
+
+    def next_start_time(self, loop):
+        # rateを指定した場合は、予定した送信時刻から応答までを計測する
+        # 応答が遅れて送信も遅れた場合に、待たされた時間を計測から漏らさない(coordinated omission対策)
+        if self.max_requests is not None and self.sent >= self.max_requests:
+            return None
+        if self.rate is None:
+            start_time = loop.time()
+        else:
+            start_time = self.started_at + self.sent / self.rate
+        if start_time >= self.started_at + self.duration:
+            return None
+        self.sent += 1
+        return start_time
+
+    async def worker(self, loop, url):
+        port = url.port or 80
+        path = urllib.parse.urlunsplit(('', '', url.path or '/', url.query, ''))
+        request = (
+            f'GET {path} HTTP/1.1\r\n'
+            f'Host: {url.netloc}\r\n'
+            f'Connection: keep-alive\r\n'
+            f'User-Agent: syakyo-loadtest\r\n'
+            f'\r\n'
+        ).encode('latin-1')
+
+        reader = writer = None
+        backoff = CONNECT_BACKOFF_SECONDS
+        while True:
+            start_time = self.next_start_time(loop)
+            if start_time is None:
+                break
+            delay = start_time - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if writer is None:
+                try:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(url.hostname, port), self.timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    self.errors[type(e).__name__] += 1
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, MAX_CONNECT_BACKOFF_SECONDS)
+                    continue
+                self.connections += 1
+                backoff = CONNECT_BACKOFF_SECONDS
+
+            try:
+                writer.write(request)
+                status, is_keep_alive = await asyncio.wait_for(read_response(reader), self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                # 送受信のエラーは、次のリクエストで接続し直す
+                self.errors[type(e).__name__] += 1
+                writer.close()
+                reader = writer = None
+                continue
+
+            # マイクロ秒で記録する
+            self.histogram.record((loop.time() - start_time) * 1000000)
+            self.statuses[status] += 1
+            if not is_keep_alive:
+                writer.close()
+                reader = writer = None
+
+        if writer is not None:
+            writer.close()
+
+    def run(self):
+        loop = asyncio.get_event_loop()
+        self.started_at = loop.time()
+        workers = [self.worker(loop, self.urls[i % len(self.urls)]) for i in range(self.concurrency)]
+        loop.run_until_complete(asyncio.gather(*workers))
+        elapsed = loop.time() - self.started_at
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        def to_ms(value):
+            return round(value / 1000, 3)
+
+        return {
+            'urls': [urllib.parse.urlunsplit(url) for url in self.urls],
+            'concurrency': self.concurrency,
+            'rate': self.rate,
+            'elapsed_seconds': round(elapsed, 3),
+            'requests': self.histogram.total_count,
+            'connections': self.connections,
+            'statuses': dict(self.statuses),
+            'errors': dict(self.errors),
+            'throughput_rps': round(self.histogram.total_count / elapsed, 1) if elapsed else 0,
+            'latency_ms': {
+                'mean': to_ms(self.histogram.mean()),
+                'p50': to_ms(self.histogram.value_at_percentile(50)),
+                'p95': to_ms(self.histogram.value_at_percentile(95)),
+                'p99': to_ms(self.histogram.value_at_percentile(99)),
+                'max': to_ms(self.histogram.max_value),
+            },
+        }
+
+
+def run_load_test(urls, concurrency=10, duration=10, rate=None, max_requests=None):
+    print(f'負荷テスト開始：{datetime.datetime.now()}')
+    result = LoadTest(urls, concurrency, duration, rate, max_requests).run()
+    print(f'負荷テスト終了：{datetime.datetime.now()}')
+    print_response('load test', json.dumps(result, indent=2, ensure_ascii=False))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    target = parser.add_mutually_exclusive_group()
+    # 対象の指定がない場合は、aws.jsonのWebサーバーを対象とする
+    target.add_argument('--url', action='append', help='対象のURL(複数指定可)')
+    target.add_argument('--stack', help='インベントリのスタック名。パブリックサブネットのインスタンスを対象とする')
+    target.add_argument('--local', action='store_true', help='ローカルに立てたHTTPサーバーを対象とする')
+    parser.add_argument('--concurrency', type=int, default=10, help='同時接続数')
+    parser.add_argument('--duration', type=float, default=10, help='実行する秒数')
+    parser.add_argument('--rate', type=float, help='1秒あたりのリクエスト数(指定しない場合は上限なし)')
+    parser.add_argument('--requests', type=int, help='リクエスト数の上限')
+    parser.add_argument('--output', help='結果を保存するJSONファイル')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as exit_stack:
+        if args.local:
+            urls = [exit_stack.enter_context(run_local_server())]
+        elif args.url:
+            urls = args.url
+        else:
+            urls = find_web_urls(args.stack)
+        if not urls:
+            raise SystemExit('対象のWebサーバーが見つかりませんでした。`python inventory.py refresh`を実行してください。')
+
+        result = run_load_test(urls, args.concurrency, args.duration, args.rate, args.requests)
+
+    if args.output:
+        with open(args.output, mode='w') as f:
+            json.dump(result, f, indent=2)
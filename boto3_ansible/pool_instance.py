@@ -0,0 +1,233 @@
+import argparse
+import datetime
+import inspect
+import json
+import sys
+import time
+from botocore.exceptions import ClientError
+from clear_all import terminate_instances_with_wait, delete_security_group
+from util import create_session, create_ec2_client, create_ec2_resource, lock_file, load_json, save_json, print_response
+
+# 停止状態のEC2インスタンスのプールを、aws.jsonと同じくJSONファイルで管理する
+# プライベートIPアドレスは固定しているため、サブネットIDとプライベートIPアドレスの組をプロファイルとする
+# 停止中のインスタンスもプライベートIPアドレスを持ち続けるので、1つのプロファイルにプールできるのは1台だけになる
+# そのため、このプールは「削除する代わりに停止しておき、次は起動するだけで済ませる」ためのものとなる
+# { 'サブネットID/プライベートIP': [{instance_id, security_group_id, pooled_at}, ...] }
+POOL_FILE = 'instance_pool.json'
+
+# chapterごとのインスタンスの作り方を、aws.jsonのキーと合わせて定義しておく
+PROFILES = {
+    'web': {
+        'subnet_key': 'public_subnet_id',
+        'security_group_key': 'web_security_group_id',
+        'instance_key': 'web_instance_id',
+        'private_ip': '192.168.1.10',
+    },
+    'db': {
+        'subnet_key': 'private_subnet_id',
+        'security_group_key': 'db_security_group_id',
+        'instance_key': 'db_instance_id',
+        'private_ip': '192.168.2.10',
+    },
+}
+
+# プール全体で停止しておくインスタンスの数(プロファイルごとには最大1台)
+# 停止中もEBSの料金はかかるため、上限を決めておく
+DEFAULT_MAX_SIZE = 2
+DEFAULT_MAX_IDLE_SECONDS = 24 * 60 * 60
+
+
+def create_profile_key(subnet_id, private_ip):
+    return f'{subnet_id}/{private_ip}'
+
+
+def create_instance_name_tag(ec2_instance, instance_name):
+    # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Instance.create_tags
+    tag = ec2_instance.create_tags(
+        Tags=[{
+            'Key': 'Name',
+            'Value': instance_name,
+        }]
+    )
+    print_response(inspect.getframeinfo(inspect.currentframe())[2], tag)
+
+
+def stop_instance_with_wait(ec2_instance):
+    # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Instance.stop
+    # boto3 1.4.5のstop_instancesにはHibernateの指定がないため、通常の停止とする
+    response = ec2_instance.stop()
+    print_response(inspect.getframeinfo(inspect.currentframe())[2], response)
+    print(f'停止待ち: {datetime.datetime.now()}')
+    ec2_instance.wait_until_stopped()
+    print(f'停止しました：{datetime.datetime.now()}')
+
+
+def start_instance_with_wait(ec2_instance):
+    # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Instance.start
+    response = ec2_instance.start()
+    print_response(inspect.getframeinfo(inspect.currentframe())[2], response)
+    print(f'起動待ち: {datetime.datetime.now()}')
+    ec2_instance.wait_until_running()
+    print(f'起動しました：{datetime.datetime.now()}')
+
+
+def destroy_pooled_instance(ec2_client, entry):
+    # セキュリティグループはプールのインスタンス専用なので、インスタンスと一緒に削除する
+    # プールの外で削除済のものもあるため、見つからない場合は削除済とみなす
+    try:
+        terminate_instances_with_wait(ec2_client, entry['instance_id'])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+            raise
+    try:
+        delete_security_group(ec2_client, entry['security_group_id'])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidGroup.NotFound':
+            raise
+
+
+def claim_instance(ec2_resource, subnet_id, private_ip, instance_name):
+    # プールから停止中のインスタンスを1つ取り出して起動する
+    # 取り出せない場合はNoneを返すので、呼び出し元で通常どおり作成する
+    profile_key = create_profile_key(subnet_id, private_ip)
+    while True:
+        with lock_file(POOL_FILE):
+            pool = load_json(POOL_FILE)
+            entries = pool.get(profile_key, [])
+            if not entries:
+                return None
+            entry = entries.pop(0)
+            save_json(POOL_FILE, pool)
+
+        # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#instance
+        ec2_instance = ec2_resource.Instance(entry['instance_id'])
+        try:
+            state = ec2_instance.state['Name']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                raise
+            state = 'terminated'
+        if state == 'stopping':
+            ec2_instance.wait_until_stopped()
+            break
+        if state == 'stopped':
+            break
+
+        # プールの外で起動・削除されたなど、使えないものは削除して次を探す
+        # プールから除くだけだと、インスタンスとセキュリティグループが残り続けてしまう
+        print(f'使えないインスタンスを削除します：{entry["instance_id"]}')
+        destroy_pooled_instance(ec2_resource.meta.client, entry)
+
+    create_instance_name_tag(ec2_instance, instance_name)
+    start_instance_with_wait(ec2_instance)
+    print_response(inspect.getframeinfo(inspect.currentframe())[2], entry)
+    return entry
+
+
+def return_instance(ec2_resource, subnet_id, private_ip, instance_id, security_group_id):
+    # 使い終わったインスタンスを停止してプールに戻す
+    ec2_instance = ec2_resource.Instance(instance_id)
+    stop_instance_with_wait(ec2_instance)
+    create_instance_name_tag(ec2_instance, f'pool:{create_profile_key(subnet_id, private_ip)}')
+
+    entry = {
+        'instance_id': instance_id,
+        'security_group_id': security_group_id,
+        'pooled_at': time.time(),
+    }
+    with lock_file(POOL_FILE):
+        pool = load_json(POOL_FILE)
+        pool.setdefault(create_profile_key(subnet_id, private_ip), []).append(entry)
+        save_json(POOL_FILE, pool)
+    print_response(inspect.getframeinfo(inspect.currentframe())[2], entry)
+
+
+def trim_pool(ec2_client, max_size=DEFAULT_MAX_SIZE, max_idle_seconds=DEFAULT_MAX_IDLE_SECONDS, subnet_id=None):
+    # 待機時間の上限を超えたもの、およびプール全体でmax_sizeを超えた古いものを削除してコストを抑える
+    now = time.time()
+    pooled = []
+    with lock_file(POOL_FILE):
+        pool = load_json(POOL_FILE)
+        for profile_key, entries in pool.items():
+            pooled.extend((profile_key, e) for e in entries)
+        pooled.sort(key=lambda p: p[1]['pooled_at'], reverse=True)
+
+        keep = []
+        expired = []
+        for profile_key, entry in pooled:
+            is_target = subnet_id is None or profile_key.startswith(f'{subnet_id}/')
+            if is_target and (len(keep) >= max_size or now - entry['pooled_at'] > max_idle_seconds):
+                expired.append(entry)
+            else:
+                keep.append((profile_key, entry))
+
+        pool = {}
+        for profile_key, entry in keep:
+            pool.setdefault(profile_key, []).append(entry)
+        save_json(POOL_FILE, pool)
+
+    for entry in expired:
+        destroy_pooled_instance(ec2_client, entry)
+    print_response(inspect.getframeinfo(inspect.currentframe())[2], expired)
+
+
+def free_private_ip(ec2_client, subnet_id, private_ip):
+    # プールを使わずに作成する場合、プールの停止中のインスタンスが固定のプライベートIPアドレスを持っていると
+    # InvalidIPAddress.InUseで起動できないため、先にそのプロファイルのインスタンスを削除する
+    profile_key = create_profile_key(subnet_id, private_ip)
+    with lock_file(POOL_FILE):
+        pool = load_json(POOL_FILE)
+        entries = pool.pop(profile_key, [])
+        save_json(POOL_FILE, pool)
+
+    for entry in entries:
+        print(f'プライベートIPアドレス{private_ip}を空けるため、プールのインスタンスを削除します：{entry["instance_id"]}')
+        destroy_pooled_instance(ec2_client, entry)
+
+
+def drain_pool(ec2_client, subnet_id):
+    # サブネットを削除する前に、そのサブネットのプールを空にする
+    trim_pool(ec2_client, max_size=0, subnet_id=subnet_id)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    release_parser = subparsers.add_parser('release')
+    release_parser.add_argument('profile', choices=PROFILES.keys())
+    trim_parser = subparsers.add_parser('trim')
+    trim_parser.add_argument('--size', type=int, default=DEFAULT_MAX_SIZE)
+    trim_parser.add_argument('--max-idle-seconds', type=int, default=DEFAULT_MAX_IDLE_SECONDS)
+    subparsers.add_parser('status')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        print_response('instance pool', load_json(POOL_FILE))
+        sys.exit()
+
+    session = create_session()
+    client = create_ec2_client(session)
+    resource = create_ec2_resource(session)
+
+    if args.command == 'release':
+        # ch3/ch6で作ったインスタンスを、削除せずに停止してプールへ戻す
+        # サブネットはプールのインスタンスが使い続けるので、aws.jsonに残しておく
+        profile = PROFILES[args.profile]
+        with open('aws.json', mode='r') as f:
+            aws = json.load(f)
+        return_instance(
+            resource, aws[profile['subnet_key']], profile['private_ip'],
+            aws[profile['instance_key']], aws[profile['security_group_key']])
+        del aws[profile['instance_key']]
+        del aws[profile['security_group_key']]
+        with open('aws.json', mode='w') as f:
+            json.dump(aws, f)
+
+        # 戻した結果、上限を超えたものや古いものを削除する
+        trim_pool(client)
+
+    elif args.command == 'trim':
+        trim_pool(client, args.size, args.max_idle_seconds)
+
+    else:
+        parser.print_help()
@@ -0,0 +1,299 @@
+import argparse
+import datetime
+import inspect
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+from botocore.exceptions import ClientError
+from ch7 import create_elastic_ip, create_nat_gateway, wait_nat_gateway_available
+from clear_all import delete_route_from_main_route_table, delete_nat_gateway, delete_elastic_ip
+from util import create_session, create_ec2_client, lock_file, load_json, save_json, print_response
+
+# プールの状態は、aws.jsonと同じくJSONファイルで管理する
+# NATゲートウェイはサブネットに置かれ、サブネットはアベイラビリティゾーンに結びついているので、サブネットIDごとに管理する
+# { パブリックサブネットID: [{id, state, allocation_id, nat_gateway_id, pooled_at, pid}, ...] }
+# state
+#   pending   : 作成中(作成しているプロセスのpidを持つ)
+#   available : すぐに使える
+#   expired   : 使えないため、次のtrimで削除する
+POOL_FILE = 'nat_pool.json'
+
+# サブネットごとに確保しておくNATゲートウェイの数
+DEFAULT_POOL_SIZE = 1
+# NATゲートウェイとElastic IPは待機中も課金されるため、待機時間の上限を決めておく
+DEFAULT_MAX_IDLE_SECONDS = 60 * 60
+
+
+def describe_nat_gateway_state(ec2_client, nat_gateway_id):
+    # https://boto3.readthedocs.io/en/latest/reference/services/ec2.html#EC2.Client.describe_nat_gateways
+    try:
+        response = ec2_client.describe_nat_gateways(NatGatewayIds=[nat_gateway_id])
+    except ClientError as e:
+        # プールの外で削除され、すでに存在しない場合
+        if e.response['Error']['Code'] == 'NatGatewayNotFound':
+            return 'deleted'
+        raise
+    return response['NatGateways'][0]['State']
+
+
+def wait_nat_gateway_deleted(ec2_client, nat_gateway_id):
+    # NATゲートウェイが削除されるまでは、Elastic IPを解放できない
+    # boto3 1.4.5にはNatGatewayDeletedのwaiterがないため、自前でポーリングする
+    while describe_nat_gateway_state(ec2_client, nat_gateway_id) != 'deleted':
+        time.sleep(15)
+
+
+def destroy_pooled_nat_gateway(ec2_client, entry):
+    # 作成途中で止まったものは、NATゲートウェイやElastic IPのIDがないことがある
+    if entry.get('nat_gateway_id'):
+        if describe_nat_gateway_state(ec2_client, entry['nat_gateway_id']) not in ('deleting', 'deleted'):
+            delete_nat_gateway(ec2_client, entry['nat_gateway_id'])
+        wait_nat_gateway_deleted(ec2_client, entry['nat_gateway_id'])
+    if entry.get('allocation_id'):
+        try:
+            delete_elastic_ip(ec2_client, entry['allocation_id'])
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidAllocationID.NotFound':
+                raise
+
+
+def get_state(entry):
+    return entry.get('state', 'available')
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def update_pooled_entry(subnet_id, entry_id, **changes):
+    with lock_file(POOL_FILE):
+        pool = load_json(POOL_FILE)
+        for entry in pool.get(subnet_id, []):
+            if entry['id'] == entry_id:
+                entry.update(changes)
+        save_json(POOL_FILE, pool)
+
+
+def add_nat_gateway_to_pool(ec2_client, subnet_id):
+    # 作成を始める前に作成中として登録しておき、作成中の分もプールの数に含める
+    # 作成とavailableまでの待ちは時間がかかるので、ロックの外で行う
+    entry_id = uuid.uuid4().hex
+    with lock_file(POOL_FILE):
+        pool = load_json(POOL_FILE)
+        pool.setdefault(subnet_id, []).append({
+            'id': entry_id,
+            'state': 'pending',
+            'allocation_id': None,
+            'nat_gateway_id': None,
+            'pooled_at': time.time(),
+            'pid': os.getpid(),
+        })
+        save_json(POOL_FILE, pool)
+
+    allocation_id = create_elastic_ip(ec2_client)
+    update_pooled_entry(subnet_id, entry_id, allocation_id=allocation_id)
+    nat_gateway_id = create_nat_gateway(ec2_client, allocation_id, subnet_id)
+    update_pooled_entry(subnet_id, entry_id, nat_gateway_id=nat_gateway_id)
+    wait_nat_gateway_available(ec2_client, nat_gateway_id)
+    update_pooled_entry(subnet_id, entry_id, state='available', pooled_at=time.time())
+    print_response(inspect.getframeinfo(inspect.currentframe())[2], nat_gateway_id)
+
+
+def fill_pool(ec2_client, subnet_id, size=DEFAULT_POOL_SIZE, max_idle_seconds=DEFAULT_MAX_IDLE_SECONDS):
+    # 使えないもの・待機時間の上限を超えたものを先に削除し、残ったものだけを数に含める
+    # 削除せずに数えると、足りない分を作らないまま最後のtrimで削除してしまい、プールが空になる
+    trim_pool(ec2_client, size, max_idle_seconds, subnet_id)
+
+    # 作成中のものも数に含めるため、同時に複数のfillが動いても上限を超えにくい
+    with lock_file(POOL_FILE):
+        shortage = size - len(load_json(POOL_FILE).get(subnet_id, []))
+    for _ in range(shortage):
+        add_nat_gateway_to_pool(ec2_client, subnet_id)
+
+    # 補充中にreleaseなどで戻されて上限を超えた分を削除する
+    trim_pool(ec2_client, size, max_idle_seconds)
+
+
+def refill_pool_in_background(subnet_id, size=DEFAULT_POOL_SIZE):
+    # 補充はNATゲートウェイがavailableになるまで数分かかるため、別プロセスで行い呼び出し元を待たせない
+    # 補充した後も、待機時間の上限が来たら削除するよう、プールが空になるまで見張らせる
+    # 呼び出し元の端末の入力を奪わないよう、標準入力は渡さない(MFAの認証情報は呼び出し元がキャッシュしたものを使う)
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), 'fill', subnet_id, '--size', str(size), '--watch'],
+        stdin=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    print(f'プールの補充をバックグラウンドで開始しました(pid: {process.pid})：{datetime.datetime.now()}')
+    return process
+
+
+def claim_nat_gateway(ec2_client, subnet_id):
+    # プールからavailableなNATゲートウェイを1つ取り出す
+    # 取り出せない場合はNoneを返すので、呼び出し元で通常どおり作成する
+    while True:
+        with lock_file(POOL_FILE):
+            pool = load_json(POOL_FILE)
+            entries = [e for e in pool.get(subnet_id, []) if get_state(e) == 'available']
+            if not entries:
+                return None
+            entry = entries[0]
+            pool[subnet_id].remove(entry)
+            save_json(POOL_FILE, pool)
+
+        if describe_nat_gateway_state(ec2_client, entry['nat_gateway_id']) == 'available':
+            print_response(inspect.getframeinfo(inspect.currentframe())[2], entry)
+            return entry
+
+        # プールの外で削除されたなど、使えないものは削除対象としてプールに戻し、次を探す
+        # Elastic IPの解放まで待つと時間がかかるため、削除は次のtrim(補充の最後にも実行される)で行う
+        entry['state'] = 'expired'
+        with lock_file(POOL_FILE):
+            pool = load_json(POOL_FILE)
+            pool.setdefault(subnet_id, []).append(entry)
+            save_json(POOL_FILE, pool)
+        print(f'使えないNATゲートウェイを削除対象にしました：{entry["nat_gateway_id"]}')
+
+
+def return_nat_gateway(ec2_client, subnet_id, allocation_id, nat_gateway_id, max_size=DEFAULT_POOL_SIZE):
+    # 使い終わったNATゲートウェイをプールに戻す。プールが満杯の場合は削除する
+    entry = {
+        'id': uuid.uuid4().hex,
+        'state': 'available',
+        'allocation_id': allocation_id,
+        'nat_gateway_id': nat_gateway_id,
+        'pooled_at': time.time(),
+    }
+    with lock_file(POOL_FILE):
+        pool = load_json(POOL_FILE)
+        entries = pool.setdefault(subnet_id, [])
+        is_pooled = len(entries) < max_size
+        if is_pooled:
+            entries.append(entry)
+            save_json(POOL_FILE, pool)
+
+    if not is_pooled:
+        destroy_pooled_nat_gateway(ec2_client, entry)
+    print_response(inspect.getframeinfo(inspect.currentframe())[2], {'pooled': is_pooled, **entry})
+
+
+def trim_pool(ec2_client, max_size=DEFAULT_POOL_SIZE, max_idle_seconds=DEFAULT_MAX_IDLE_SECONDS, subnet_id=None):
+    # 待機時間の上限を超えたもの、max_sizeを超えた古いもの、使えないものを削除してコストを抑える
+    # 作成中のものは、作成しているプロセスに任せて残す(数はmax_sizeに含める)
+    # ただし、作成していたプロセスが終了している(途中で失敗した・killされた)ものは、作成済の分を削除する
+    now = time.time()
+    expired = []
+    with lock_file(POOL_FILE):
+        pool = load_json(POOL_FILE)
+        for pooled_subnet_id, entries in pool.items():
+            if subnet_id is not None and pooled_subnet_id != subnet_id:
+                continue
+            pending = [e for e in entries if get_state(e) == 'pending' and is_process_alive(e['pid'])]
+            available = sorted(
+                (e for e in entries if get_state(e) == 'available'), key=lambda e: e['pooled_at'], reverse=True)
+            keep = [e for e in available[:max(max_size - len(pending), 0)] if now - e['pooled_at'] <= max_idle_seconds]
+            expired.extend(e for e in entries if e not in pending and e not in keep)
+            pool[pooled_subnet_id] = pending + keep
+        save_json(POOL_FILE, pool)
+
+    for entry in expired:
+        destroy_pooled_nat_gateway(ec2_client, entry)
+    print_response(inspect.getframeinfo(inspect.currentframe())[2], expired)
+
+
+def watch_pool(ec2_client, max_size=DEFAULT_POOL_SIZE, max_idle_seconds=DEFAULT_MAX_IDLE_SECONDS, subnet_id=None):
+    # fill・release・trimを実行しなくても待機時間の上限で削除されるよう、最も古いものの期限まで待ってはtrimする
+    # プールが空になったら終了する
+    while True:
+        trim_pool(ec2_client, max_size, max_idle_seconds, subnet_id)
+        with lock_file(POOL_FILE):
+            pool = load_json(POOL_FILE)
+        entries = [e for pooled_subnet_id, entries in pool.items() for e in entries
+                   if subnet_id is None or pooled_subnet_id == subnet_id]
+        if not entries:
+            break
+
+        # 作成中のものしかない場合は、作成が終わるか失敗するのを待つ
+        deadlines = [e['pooled_at'] + max_idle_seconds for e in entries if get_state(e) == 'available']
+        wait_seconds = min(deadlines) - time.time() + 1 if deadlines else 15
+        print(f'次のtrimまで{max(wait_seconds, 1):.0f}秒待ちます：{datetime.datetime.now()}')
+        time.sleep(max(wait_seconds, 1))
+
+
+def drain_pool(ec2_client, subnet_id):
+    # サブネットを削除する前に、そのサブネットのプールを空にする
+    # バックグラウンドの補充が作成中のものは、作成が終わるのを待ってから削除する
+    while True:
+        trim_pool(ec2_client, max_size=0, subnet_id=subnet_id)
+        with lock_file(POOL_FILE):
+            if not load_json(POOL_FILE).get(subnet_id):
+                break
+        print(f'作成中のNATゲートウェイを待っています：{datetime.datetime.now()}')
+        time.sleep(15)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    fill_parser = subparsers.add_parser('fill')
+    fill_parser.add_argument('subnet_id', nargs='?')
+    fill_parser.add_argument('--size', type=int, default=DEFAULT_POOL_SIZE)
+    fill_parser.add_argument('--max-idle-seconds', type=int, default=DEFAULT_MAX_IDLE_SECONDS)
+    # --watchを指定した場合は、補充した後もプールが空になるまで待機時間の上限を見張る
+    fill_parser.add_argument('--watch', action='store_true')
+    trim_parser = subparsers.add_parser('trim')
+    trim_parser.add_argument('--size', type=int, default=DEFAULT_POOL_SIZE)
+    trim_parser.add_argument('--max-idle-seconds', type=int, default=DEFAULT_MAX_IDLE_SECONDS)
+    trim_parser.add_argument('--watch', action='store_true')
+    release_parser = subparsers.add_parser('release')
+    release_parser.add_argument('--size', type=int, default=DEFAULT_POOL_SIZE)
+    subparsers.add_parser('status')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        print_response('nat pool', load_json(POOL_FILE))
+        sys.exit()
+
+    session = create_session()
+    client = create_ec2_client(session)
+
+    if args.command == 'fill':
+        subnet_id = args.subnet_id
+        if subnet_id is None:
+            # サブネットの指定がない場合は、aws.jsonのパブリックサブネットを使う
+            with open('aws.json', mode='r') as f:
+                subnet_id = json.load(f)['public_subnet_id']
+        fill_pool(client, subnet_id, args.size, args.max_idle_seconds)
+        if args.watch:
+            watch_pool(client, args.size, args.max_idle_seconds, subnet_id)
+
+    elif args.command == 'trim':
+        if args.watch:
+            watch_pool(client, args.size, args.max_idle_seconds)
+        else:
+            trim_pool(client, args.size, args.max_idle_seconds)
+
+    elif args.command == 'release':
+        # ch7で使ったNATゲートウェイを、削除せずにプールへ戻す
+        with open('aws.json', mode='r') as f:
+            aws = json.load(f)
+        delete_route_from_main_route_table(client, aws['main_route_table_id'])
+        return_nat_gateway(client, aws['public_subnet_id'], aws['allocation_id'], aws['nat_gateway_id'], args.size)
+        for key in ('allocation_id', 'nat_gateway_id', 'main_route_table_id'):
+            del aws[key]
+        with open('aws.json', mode='w') as f:
+            json.dump(aws, f)
+
+        # 戻した結果、上限を超えたものや古いものを削除する
+        trim_pool(client, args.size)
+
+    else:
+        parser.print_help()
@@ -0,0 +1,51 @@
+import datetime
+import runpy
+import sys
+import time
+
+# 1つのプロセスで実行できるスクリプト
+# boto3のセッション・クライアント・サービスモデルは、util.pyで作成したものを各スクリプトで使い回す
+COMMANDS = (
+    'ch2', 'ch3', 'ch4', 'ch6', 'ch7',
+    'clear_all', 'clear_ch2',
+    'pool_nat', 'pool_instance',
+    'inventory', 'loadtest',
+)
+
+
+def split_commands(argv):
+    # `ch2 ch3 --pool ch7 --pool` を [('ch2', []), ('ch3', ['--pool']), ('ch7', ['--pool'])] に分ける
+    commands = []
+    for arg in argv:
+        if arg in COMMANDS:
+            commands.append((arg, []))
+        elif commands:
+            commands[-1][1].append(arg)
+        else:
+            raise SystemExit(f'不明なコマンドです：{arg}\n使用できるコマンド：{", ".join(COMMANDS)}')
+    return commands
+
+
+def run_command(name, args):
+    # `python <name>.py <args>`と同じように実行する
+    # モジュールは実行する時に初めてimportされるので、使わないchapterのimportのコストはかからない
+    sys.argv = [f'{name}.py', *args]
+    runpy.run_module(name, run_name='__main__', alter_sys=True)
+
+
+if __name__ == '__main__':
+    commands = split_commands(sys.argv[1:])
+    if not commands:
+        raise SystemExit(f'usage: python run.py <command> [args...] [<command> [args...] ...]\n'
+                         f'使用できるコマンド：{", ".join(COMMANDS)}')
+
+    for name, args in commands:
+        print(f'{name}を開始します：{datetime.datetime.now()}')
+        start = time.perf_counter()
+        try:
+            run_command(name, args)
+        except SystemExit as e:
+            # 各スクリプトのsys.exit()で、後続のコマンドまで止めないようにする
+            if e.code not in (None, 0):
+                raise
+        print(f'{name}が終了しました({time.perf_counter() - start:.3f}秒)：{datetime.datetime.now()}')
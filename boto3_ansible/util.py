@@ -1,7 +1,188 @@
+import contextlib
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+
+PROFILE_NAME = 'my-profile'
+
+# botocoreのサービスモデル(EC2は数MBのJSON)をパースした結果を保存しておくディレクトリ
+# pickleは読み込むとコードを実行できるため、自分だけが書き込めるディレクトリにする
+MODEL_CACHE_DIR = os.path.expanduser('~/.cache/syakyo_aws_network_server2/botocore')
+
+# AssumeRoleで取得した一時的な認証情報を、複数のプロセスで共有するために保存しておくディレクトリ
+CREDENTIAL_CACHE_DIR = os.path.expanduser('~/.cache/syakyo_aws_network_server2/credentials')
+# キャッシュのファイル名に含める設定(同じprofile名でも、ロールや認証元を変えたら別のキャッシュにする)
+CREDENTIAL_CACHE_KEYS = ('role_arn', 'source_profile', 'mfa_serial', 'external_id')
+# 有効期限までこの秒数を切ったら更新する(botocoreのRefreshableCredentialsの更新を始める時間と合わせる)
+CREDENTIAL_REFRESH_SECONDS = 15 * 60
+
+
+@functools.lru_cache(maxsize=None)
+def create_session():
+    # boto3のimportとセッションの作成は重いため、必要になった時に1回だけ行い、同じプロセスでは使い回す
+    import boto3
+    # profileを使い分ける場合には、profileをセット
+    session = boto3.Session(profile_name=PROFILE_NAME)
+    # サービスモデルやエンドポイントのJSONは、パース済のものをディスクから読み込む
+    # https://botocore.readthedocs.io/en/latest/reference/loaders.html
+    loader = session._session.get_component('data_loader')
+    loader.file_loader = create_cached_json_file_loader()
+    # profileがAssumeRoleする場合は、ディスクに保存した認証情報を使う
+    install_cached_assume_role_provider(session)
+    return session
+
+
+def create_cached_json_file_loader():
+    from botocore.loaders import JSONFileLoader
+
+    class CachedJSONFileLoader(JSONFileLoader):
+        def load_file(self, file_path):
+            full_path = f'{file_path}.json'
+            if not os.path.isfile(full_path):
+                return super().load_file(file_path)
+
+            # botocoreを更新した場合に古いキャッシュを使わないよう、パスと更新日時とサイズをキーにする
+            stat = os.stat(full_path)
+            key = hashlib.sha1(f'{full_path}:{stat.st_mtime_ns}:{stat.st_size}'.encode()).hexdigest()
+            cache_path = os.path.join(MODEL_CACHE_DIR, f'{key}.pickle')
+            os.makedirs(MODEL_CACHE_DIR, mode=0o700, exist_ok=True)
+            # 他のユーザーが書き込めるキャッシュは読み込まず、キャッシュも作らない
+            if not is_private_path(MODEL_CACHE_DIR):
+                return super().load_file(file_path)
+
+            try:
+                with open(cache_path, mode='rb') as f:
+                    if is_private_path(f.fileno()):
+                        return pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+
+            data = super().load_file(file_path)
+            # 他のプロセスが書きかけのキャッシュを読まないよう、一時ファイルに書いてからリネームする
+            tmp_path = f'{cache_path}.{os.getpid()}'
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), mode='wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+            return data
+
+    return CachedJSONFileLoader()
+
+
+def is_private_path(path):
+    # 自分が所有していて、グループと他のユーザーが書き込めないことを確認する(pathにはファイルディスクリプタも使える)
+    stat = os.stat(path)
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+
+def install_cached_assume_role_provider(session):
+    botocore_session = session._session
+    config = botocore_session.get_scoped_config()
+    if 'role_arn' not in config or 'source_profile' not in config:
+        return
+
+    from botocore.credentials import CredentialProvider, RefreshableCredentials
+
+    class CachedAssumeRoleProvider(CredentialProvider):
+        METHOD = 'cached-assume-role'
+
+        def load(self):
+            cache_path = create_credential_cache_path(PROFILE_NAME, config)
+            refresh = functools.partial(load_assumed_role_credentials, PROFILE_NAME, config, cache_path)
+            credentials = RefreshableCredentials.create_from_metadata(
+                metadata=refresh(),
+                refresh_using=refresh,
+                method=self.METHOD,
+            )
+            # MFAはコードの入力が必要なため、バックグラウンドでは更新せず、期限が近づいて参照した時に入力してもらう
+            if 'mfa_serial' not in config:
+                refresh_credentials_in_background(cache_path, credentials)
+            return credentials
+
+    # 環境変数の認証情報は優先したいので、botocoreのAssumeRoleの直前に入れる
+    # https://botocore.readthedocs.io/en/latest/reference/credentials.html
+    resolver = botocore_session.get_component('credential_provider')
+    resolver.insert_before('assume-role', CachedAssumeRoleProvider())
+
+
+def create_credential_cache_path(profile_name, config):
+    # profile名だけをキーにすると、~/.aws/configでrole_arnなどを変えても古いロールの認証情報を使ってしまう
+    settings = json.dumps({key: config.get(key) for key in CREDENTIAL_CACHE_KEYS}, sort_keys=True)
+    key = hashlib.sha1(settings.encode()).hexdigest()[:16]
+    return os.path.join(CREDENTIAL_CACHE_DIR, f'{profile_name}-{key}.json')
+
+
+def load_assumed_role_credentials(profile_name, config, cache_path):
+    # ロックを取ってからキャッシュを確認することで、同時に起動した複数のプロセスのうち1つだけがSTSを呼び出す
+    # 他のプロセスはロックが外れるのを待って、更新されたキャッシュを使う
+    os.makedirs(CREDENTIAL_CACHE_DIR, mode=0o700, exist_ok=True)
+    with lock_file(cache_path):
+        cached = load_json(cache_path)
+        if cached and cached['expiry_epoch'] - time.time() > CREDENTIAL_REFRESH_SECONDS:
+            return cached
+
+        import boto3
+        # https://boto3.readthedocs.io/en/latest/reference/services/sts.html#STS.Client.assume_role
+        sts_client = boto3.Session(profile_name=config['source_profile']).client('sts')
+        params = {
+            'RoleArn': config['role_arn'],
+            'RoleSessionName': config.get('role_session_name', f'{profile_name}-{int(time.time())}'),
+        }
+        if 'external_id' in config:
+            params['ExternalId'] = config['external_id']
+        if 'mfa_serial' in config:
+            # 端末がない(cronやバックグラウンドのプール補充など)場合は、入力を待ち続けないよう止める
+            if not sys.stdin.isatty():
+                raise SystemExit(
+                    f'MFAコードを入力できないため、{config["mfa_serial"]}でAssumeRoleできません。'
+                    f'端末から実行して認証情報をキャッシュしてください。')
+            params['SerialNumber'] = config['mfa_serial']
+            params['TokenCode'] = input(f'Enter MFA code for {config["mfa_serial"]}: ')
+        response = sts_client.assume_role(**params)
+
+        credentials = response['Credentials']
+        metadata = {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+            'expiry_epoch': credentials['Expiration'].timestamp(),
+        }
+        # 認証情報なので、自分だけが読めるファイルにする
+        tmp_path = f'{cache_path}.{os.getpid()}'
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), mode='w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, cache_path)
+        return metadata
+
+
+def refresh_credentials_in_background(cache_path, credentials):
+    # 有効期限が近づいたら、EC2の処理を待たせないよう、バックグラウンドで更新しておく
+    def run():
+        while True:
+            cached = load_json(cache_path)
+            # 更新を始める時刻を少し過ぎてから参照する
+            wait_seconds = cached.get('expiry_epoch', 0) - time.time() - CREDENTIAL_REFRESH_SECONDS + 10
+            time.sleep(max(wait_seconds, 60))
+            # RefreshableCredentialsは、期限が近ければ参照した時に更新する
+            # 他のプロセスがすでに更新していれば、STSは呼ばずにキャッシュを読むだけになる
+            credentials.get_frozen_credentials()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+@functools.lru_cache(maxsize=None)
 def create_ec2_client(session):
+    # 1つのプロセスで複数のchapterを実行する場合に備え、同じsessionではクライアントを使い回す
     return session.client('ec2', region_name='ap-northeast-1')
 
 
+@functools.lru_cache(maxsize=None)
 def create_ec2_resource(session):
     return session.resource('ec2', region_name='ap-northeast-1')
 
@@ -9,3 +190,26 @@ def create_ec2_resource(session):
 def print_response(function_name, response):
     line = '-' * 20
     print(f'{line}\n{function_name}\n{line}\n{response}\n')
+
+
+@contextlib.contextmanager
+def lock_file(path):
+    # 複数のプロセスが同じJSONファイルを同時に書き換えないよう、ロックファイルで排他する
+    with open(f'{path}.lock', mode='w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, mode='r') as f:
+        return json.load(f)
+
+
+def save_json(path, data):
+    with open(path, mode='w') as f:
+        json.dump(data, f)